@@ -3,13 +3,15 @@
 #
 # See this guide on how to implement these action:
 # https://rasa.com/docs/rasa/custom-actions
+import functools
 import logging
 import os
 import re
+from operator import itemgetter
 from typing import Text, Dict, Any, List, cast, Callable
 
-from elasticsearch import Elasticsearch
-from rasa_sdk import Tracker, utils
+from elasticsearch import AsyncElasticsearch
+from rasa_sdk import Tracker
 from rasa_sdk.events import SlotSet
 from rasa_sdk.executor import CollectingDispatcher
 from rasa_sdk.knowledge_base.actions import ActionQueryKnowledgeBase
@@ -19,12 +21,16 @@ from rasa_sdk.knowledge_base.utils import SLOT_OBJECT_TYPE, SLOT_ATTRIBUTE, \
 from rasa_sdk.types import DomainDict
 
 from actions.storage import DefaultAttribute, DocumentType, \
-    ElasticsearchKnowledgeBase, RangeAttribute, TextAttribute
+    ElasticsearchKnowledgeBase, RangeAttribute, TextAttribute, get_preference
 
 logger = logging.getLogger(__name__)
 
 SLOT_LIMIT = "limit"
 
+ES_CONNECTION_POOL_SIZE = 64
+
+SANITIZE_PATTERN = re.compile(r"[{}\[\]]")
+
 
 class BookDocumentType(DocumentType):
     def __init__(self, index: Text) -> None:
@@ -70,7 +76,7 @@ class RatingDocumentType(DocumentType):
 
 
 def sanitize(text: Text) -> Text:
-    return re.sub(r"[{}\[\]]", "", text)
+    return SANITIZE_PATTERN.sub("", text)
 
 
 def get_attribute_slots(
@@ -98,17 +104,40 @@ def get_attribute_slots(
     """
     attributes = []
 
+    slots = tracker.slots
+    entities = tracker.latest_message.get("entities", [])
+    roles = {}
+    for e in entities:
+        if 'role' in e:
+            roles.setdefault((e['entity'], e['value']), e['role'])
+
     for attr in object_attributes:
-        attr_val = tracker.get_slot(attr) if attr in tracker.slots else None
+        attr_val = slots.get(attr)
         if attr_val is not None:
-            entities = tracker.latest_message.get("entities", [])
-            role = [e['role'] for e in entities if e['entity'] == attr and e['value'] == attr_val and 'role' in e]
-            role = role[0] if len(role) else None
+            role = roles.get((attr, attr_val))
             attributes.append({"name": attr, "value": attr_val, "role": role})
 
     return attributes
 
 
+@functools.lru_cache(maxsize=None)
+def get_elasticsearch_client() -> AsyncElasticsearch:
+    """
+    Returns the Elasticsearch client shared by all actions of this process,
+    keeping its pooled keep-alive connections across requests.
+    """
+    host = os.environ['ES_HOST']
+    user = os.environ['ES_USERNAME']
+    password = os.environ['ES_PASSWORD']
+    return AsyncElasticsearch(
+        hosts=[host],
+        basic_auth=(user, password),
+        request_timeout=30,
+        connections_per_node=ES_CONNECTION_POOL_SIZE,
+        retry_on_timeout=True,
+    )
+
+
 class ActionElasticsearchKnowledgeBase(ActionQueryKnowledgeBase):
     def __init__(self):
         document_types: Dict[Text, DocumentType] = {
@@ -116,16 +145,9 @@ class ActionElasticsearchKnowledgeBase(ActionQueryKnowledgeBase):
             "movie": MovieDocumentType("movie"),
             "rating": RatingDocumentType("rating")
         }
-        host = os.environ['ES_HOST']
-        user = os.environ['ES_USERNAME']
-        password = os.environ['ES_PASSWORD']
         knowledge_base = ElasticsearchKnowledgeBase(
             document_types=document_types,
-            es=Elasticsearch(
-                hosts=[host],
-                http_auth=(user, password),
-                request_timeout=30,
-            ),
+            es=get_elasticsearch_client(),
         )
 
         super().__init__(knowledge_base)
@@ -155,10 +177,11 @@ class ActionElasticsearchKnowledgeBase(ActionQueryKnowledgeBase):
         Returns: list of slots
 
         """
-        object_type = tracker.get_slot(SLOT_OBJECT_TYPE)
-        last_object_type = tracker.get_slot(SLOT_LAST_OBJECT_TYPE)
-        attribute = tracker.get_slot(SLOT_ATTRIBUTE)
-        has_mention = tracker.get_slot(SLOT_MENTION) is not None
+        slots = tracker.slots
+        object_type = slots.get(SLOT_OBJECT_TYPE)
+        last_object_type = slots.get(SLOT_LAST_OBJECT_TYPE)
+        attribute = slots.get(SLOT_ATTRIBUTE)
+        has_mention = slots.get(SLOT_MENTION) is not None
 
         new_request = object_type != last_object_type
 
@@ -199,34 +222,26 @@ class ActionElasticsearchKnowledgeBase(ActionQueryKnowledgeBase):
 
         Returns: list of slots
         """
-        object_attributes = await utils.call_potential_coroutine(
-            self.knowledge_base.get_attributes_of_object(object_type)
-        )
+        object_attributes = await self.knowledge_base.get_attributes_of_object(object_type)
 
         # get all set attribute slots of the object type to be able to filter the
         # list of objects
-        limit = tracker.get_slot(SLOT_LIMIT)
+        limit = tracker.slots.get(SLOT_LIMIT)
         logger.info(f"Limit is {limit}")
         attributes = get_attribute_slots(tracker, object_attributes)
-        var_args = {}
+        var_args = {'preference': get_preference(tracker.sender_id)}
         if limit:
             var_args['limit'] = int(limit)
 
         # query the knowledge base
-        objects = await utils.call_potential_coroutine(
-            self.knowledge_base.get_objects(object_type, attributes, **var_args)
-        )
+        objects = await self.knowledge_base.get_objects(object_type, attributes, **var_args)
 
-        await utils.call_potential_coroutine(
-            self.utter_objects(dispatcher, object_type, objects, attributes)
-        )
+        await self.utter_objects(dispatcher, object_type, objects, attributes)
 
         if not objects:
             return reset_attribute_slots(tracker, object_attributes)
 
-        key_attribute = await utils.call_potential_coroutine(
-            self.knowledge_base.get_key_attribute_of_object(object_type)
-        )
+        key_attribute = await self.knowledge_base.get_key_attribute_of_object(object_type)
 
         last_object = None if len(objects) > 1 else objects[0][key_attribute]
 
@@ -238,7 +253,7 @@ class ActionElasticsearchKnowledgeBase(ActionQueryKnowledgeBase):
             SlotSet(SLOT_LAST_OBJECT_TYPE, object_type),
             SlotSet(
                 SLOT_LISTED_OBJECTS,
-                list(map(lambda e: e[key_attribute], objects))
+                list(map(itemgetter(key_attribute), objects))
             ),
             SlotSet(SLOT_LIMIT, None),
         ]
@@ -260,18 +275,18 @@ class ActionElasticsearchKnowledgeBase(ActionQueryKnowledgeBase):
             object_type: the object type
             objects: the list of objects
         """
-        attributes_repr = f" with {', '.join([attribute['name'] + ': ' + attribute['value'] for attribute in attributes])}" if attributes else ""
+        attributes_repr = " with " + ", ".join(
+            f"{attribute['name']}: {attribute['value']}" for attribute in attributes
+        ) if attributes else ""
         if objects:
             dispatcher.utter_message(
                 text=f"I found the following {object_type}s {attributes_repr}:"
             )
 
-            repr_function = await utils.call_potential_coroutine(
-                self.knowledge_base.get_representation_function_of_object(object_type)
-            )
+            repr_function = await self.knowledge_base.get_representation_function_of_object(object_type)
 
-            for i, obj in enumerate(objects, 1):
-                dispatcher.utter_message(text=f"{i}: {repr_function(obj)}")
+            lines = [f"{i}: {repr_function(obj)}" for i, obj in enumerate(objects, 1)]
+            dispatcher.utter_message(text="\n".join(lines))
         else:
             dispatcher.utter_message(
                 text=f"I could not find any {object_type}s {attributes_repr}."
@@ -322,18 +337,19 @@ class ActionElasticsearchKnowledgeBase(ActionQueryKnowledgeBase):
             self.use_last_object_mention,
         )
 
-        last_object = await utils.call_potential_coroutine(
-            self.knowledge_base.get_object(last_object_type, object_name)
-        )
-
-        if not object_name or not object_type or not last_object:
+        if not object_name or not object_type:
             dispatcher.utter_message(template="utter_ask_rephrase")
             return [SlotSet(SLOT_MENTION, None)]
 
-        object_of_interest = await utils.call_potential_coroutine(
-            self.knowledge_base.get_object(object_type, object_name)
+        last_object, object_of_interest = await self.knowledge_base.get_objects_multi(
+            [(last_object_type, object_name), (object_type, object_name)],
+            preference=get_preference(tracker.sender_id)
         )
 
+        if not last_object or not object_of_interest:
+            dispatcher.utter_message(template="utter_ask_rephrase")
+            return [SlotSet(SLOT_MENTION, None)]
+
         obj_repr = self.knowledge_base.document_types[object_type].to_string(object_of_interest)
         last_obj_repr = self.knowledge_base.document_types[last_object_type].to_string(last_object)
 
@@ -1,17 +1,31 @@
+import functools
+import hashlib
+import json
 import logging
+import re
+import time
 from abc import ABC, abstractmethod
-from typing import Text, Dict, List, Any, Optional
+from collections import OrderedDict
+from typing import Text, Dict, List, Any, Optional, Tuple
 
-from elasticsearch import Elasticsearch
+from elasticsearch import AsyncElasticsearch
 from rasa_sdk.knowledge_base.storage import KnowledgeBase
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_PREFERENCE = "_local"
+OBJECT_CACHE_SIZE = 1024
+OBJECT_CACHE_TTL = 60
+QUERY_CACHE_SIZE = 1024
+
+NUMBER_PATTERN = re.compile(r"^\s*(\d+)(?:\.(\d+))?\s*$", re.ASCII)
+
 
 class Attribute(ABC):
 
+    @property
     @abstractmethod
-    def get_field(self, document: Dict[Text, Any]) -> Any:
+    def field_name(self) -> Text:
         pass
 
     @abstractmethod
@@ -19,9 +33,9 @@ class Attribute(ABC):
         pass
 
 
-def generate_term_query(attribute: Text, value: Text) -> Dict:
+def generate_term_query(attribute: Text, value: Any) -> Dict:
     return {
-        "fuzzy": {
+        "term": {
             attribute: {
                 "value": value
             }
@@ -64,8 +78,9 @@ class DefaultAttribute(Attribute):
     def __init__(self, name: str) -> None:
         self._name: str = name
 
-    def get_field(self, document: Dict[Text, Any]) -> Any:
-        return document.get(self._name)
+    @property
+    def field_name(self) -> Text:
+        return self._name
 
     def generate_query(self, value: Text, role: Text) -> Dict:
         return generate_match_query(self._name, value)
@@ -77,11 +92,27 @@ class TextAttribute(DefaultAttribute):
         return generate_match_phrase_query(self._name, value)
 
 
+def normalize_number(value: Text) -> Any:
+    """
+    Rewrites numeric entity values like ' 1999' or '1999.0' to a canonical
+    string so that equivalent queries share the same request cache entry.
+    """
+    if not isinstance(value, str):
+        return value
+    match = NUMBER_PATTERN.match(value)
+    if not match:
+        return value
+    integer = match.group(1).lstrip('0') or '0'
+    fraction = (match.group(2) or '').rstrip('0')
+    return f"{integer}.{fraction}" if fraction else integer
+
+
 class RangeAttribute(DefaultAttribute):
 
     def generate_query(self, value: Text, role: Text) -> Dict:
+        value = normalize_number(value)
         if role == 'eq':
-            return generate_match_query(self._name, value)
+            return generate_term_query(self._name, value)
 
         return generate_range_query(self._name, value, role)
 
@@ -91,79 +122,193 @@ class DocumentType(ABC):
     def __init__(self, index: Text, attributes: Dict[Text, Attribute]):
         self.index: Text = index
         self.attributes: Dict[Text, Attribute] = attributes
+        self.attribute_names: List[Text] = list(attributes.keys())
+        self.field_names: List[Tuple[Text, Text]] = [
+            (name, attribute.field_name) for name, attribute in attributes.items()]
+        self.source_fields: List[Text] = list(
+            dict.fromkeys(field_name for _, field_name in self.field_names))
 
     @abstractmethod
     def to_string(self, document: Dict[Text, Any]) -> Text:
         pass
 
 
+def get_preference(sender_id: Optional[Text]) -> Text:
+    """
+    Returns a stable search preference for a conversation so that all of its
+    queries are routed to the same shard copies and reuse their caches.
+    """
+    if not sender_id:
+        return DEFAULT_PREFERENCE
+    return hashlib.md5(sender_id.encode()).hexdigest()
+
+
 class ElasticsearchKnowledgeBase(KnowledgeBase):
 
     def __init__(self, document_types: Dict[Text, DocumentType],
-                 es: Elasticsearch) -> None:
+                 es: AsyncElasticsearch) -> None:
         self.document_types: Dict[Text, DocumentType] = document_types
         self.es = es
+        self._obj_cache: "OrderedDict[Tuple[Text, Text], Tuple[float, Dict[Text, Any]]]" = OrderedDict()
+        self._build_query = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(
+            self._build_query_uncached)
         super().__init__()
 
+    def _get_cached_object(self, key: Tuple[Text, Text]) -> Optional[Dict[Text, Any]]:
+        """
+        Returns a previously retrieved object if it has not expired yet
+        """
+        entry = self._obj_cache.get(key)
+        if entry is None:
+            return None
+        timestamp, kb_obj = entry
+        if time.monotonic() - timestamp >= OBJECT_CACHE_TTL:
+            del self._obj_cache[key]
+            return None
+        self._obj_cache.move_to_end(key)
+        return kb_obj
+
+    def _cache_object(self, key: Tuple[Text, Text], kb_obj: Dict[Text, Any]) -> None:
+        """
+        Stores a retrieved object and evicts the least recently used ones
+        """
+        self._obj_cache[key] = (time.monotonic(), kb_obj)
+        self._obj_cache.move_to_end(key)
+        while len(self._obj_cache) > OBJECT_CACHE_SIZE:
+            self._obj_cache.popitem(last=False)
+
     def to_kb_obj(self, obj, object_type: Text) -> Dict[Text, Any]:
         """
         Converts ES query results to Rasa knowledge base objects
         """
         source = obj["_source"]
         document_type = self.document_types[object_type]
-        pretty = document_type.to_string(source)
-        id_ = obj['_id']
-        name = f"{pretty}"
-        kb_obj = {name: attribute.get_field(source) for name, attribute in
-                  document_type.attributes.items()}
-        kb_obj['name'] = name
-        kb_obj['id'] = id_
+        kb_obj = {name: source.get(field_name) for name, field_name in
+                  document_type.field_names}
+        kb_obj['name'] = document_type.to_string(source)
+        kb_obj['id'] = obj['_id']
         return kb_obj
 
     async def get_attributes_of_object(self, object_type: Text) -> List[Text]:
-        if object_type not in self.document_types:
+        document_type = self.document_types.get(object_type)
+        if document_type is None:
             return []
 
-        return [attribute for attribute in
-                self.document_types[object_type].attributes.keys()]
-
-    async def get_objects(
-            self, object_type: Text, attributes: List[Dict[Text, Text]],
-            limit: int = 5
-    ) -> List[Dict[Text, Any]]:
-        if object_type not in self.document_types:
-            return []
+        return document_type.attribute_names
 
+    def _build_query_uncached(
+            self, object_type: Text,
+            attributes: Tuple[Tuple[Text, Text, Optional[Text]], ...],
+            limit: int
+    ) -> Text:
+        """
+        Builds the serialized search body for the given attribute filters
+        """
         document_type = self.document_types[object_type]
-        queries = [
-            document_type.attributes[attribute["name"]].generate_query(
-                attribute["value"], attribute.get("role", None))
-            for attribute in attributes]
+        document_attributes = document_type.attributes
+        queries = [document_attributes[name].generate_query(value, role)
+                   for name, value, role in attributes]
         query = {
             "size": limit,
+            "_source": document_type.source_fields,
             "query": {
-                "bool": {
-                    "must": queries
+                "constant_score": {
+                    "filter": {
+                        "bool": {
+                            "filter": queries
+                        }
+                    }
                 }
             }
         }
+        return json.dumps(query)
+
+    async def get_objects(
+            self, object_type: Text, attributes: List[Dict[Text, Text]],
+            limit: int = 5, preference: Text = DEFAULT_PREFERENCE
+    ) -> List[Dict[Text, Any]]:
+        document_type = self.document_types.get(object_type)
+        if document_type is None:
+            return []
+
+        # sorted so that equivalent filters share a cached body
+        sorted_attributes = tuple(sorted(
+            (attribute["name"], attribute["value"], attribute.get("role", None))
+            for attribute in attributes))
+        query = self._build_query(object_type, sorted_attributes, limit)
 
         logger.info(f"Searching for {object_type} using {query}")
         index = document_type.index
-        res = self.es.search(index=index, body=query)
-        return [self.to_kb_obj(hit, object_type) for hit in res['hits']['hits']]
+        res = await self.es.search(index=index, body=query, request_cache=True,
+                                   preference=preference)
+        objects = [self.to_kb_obj(hit, object_type) for hit in res['hits']['hits']]
+        # listed objects are likely referenced in the next turns
+        for kb_obj in objects:
+            self._cache_object((object_type, kb_obj['id']), kb_obj)
+        return objects
 
     async def get_object(
-            self, object_type: Text, object_identifier: Text
+            self, object_type: Text, object_identifier: Text,
+            preference: Text = DEFAULT_PREFERENCE
     ) -> Optional[Dict[Text, Any]]:
-        if object_type not in self.document_types:
+        document_type = self.document_types.get(object_type)
+        if document_type is None:
             return None
 
+        key = (object_type, object_identifier)
+        cached = self._get_cached_object(key)
+        if cached is not None:
+            return cached
+
         logger.info(f"Retrieving {object_identifier} from {object_type}")
-        document_type = self.document_types[object_type]
         index = document_type.index
-        obj = self.es.get(index=index, id=object_identifier)
+        obj = await self.es.get(index=index, id=object_identifier,
+                                preference=preference,
+                                _source_includes=document_type.source_fields)
         if obj:
-            return self.to_kb_obj(obj, object_type)
+            kb_obj = self.to_kb_obj(obj, object_type)
+            self._cache_object(key, kb_obj)
+            return kb_obj
         else:
             return None
+
+    async def get_objects_multi(
+            self, requests: List[Tuple[Text, Text]],
+            preference: Text = DEFAULT_PREFERENCE
+    ) -> List[Optional[Dict[Text, Any]]]:
+        """
+        Retrieves several objects, possibly of different types, in a single
+        multi get request. Results are returned in the order of the requests,
+        with None for unknown object types or missing documents.
+        """
+        found = {}
+        missing = []
+        for request in requests:
+            if request[0] not in self.document_types:
+                continue
+            cached = self._get_cached_object(request)
+            if cached is not None:
+                found[request] = cached
+            else:
+                missing.append(request)
+
+        if missing:
+            logger.info(f"Retrieving {missing}")
+            body = {
+                "docs": [
+                    {
+                        "_index": self.document_types[object_type].index,
+                        "_id": object_identifier,
+                        "_source": self.document_types[object_type].source_fields
+                    }
+                    for object_type, object_identifier in missing
+                ]
+            }
+            res = await self.es.mget(body=body, preference=preference)
+            for request, doc in zip(missing, res['docs']):
+                if doc.get('found'):
+                    kb_obj = self.to_kb_obj(doc, request[0])
+                    self._cache_object(request, kb_obj)
+                    found[request] = kb_obj
+
+        return [found.get(request) for request in requests]